@@ -0,0 +1,60 @@
+from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, Index
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+
+engine = create_engine('sqlite:///hotwheels.db')
+Base = declarative_base()
+
+class Product(Base):
+    __tablename__ = 'products'
+
+    id = Column(Integer, primary_key=True)
+    # Горячая выборка "товары категории" - по индексу, а не полным сканом
+    category = Column(String, nullable=False, index=True)
+    name = Column(String, nullable=False)
+    price = Column(Integer, nullable=False)
+    photo_id = Column(String, nullable=False)
+    # JSON-список всех размеров фото от Telegram: [{file_id, width, height}, ...]
+    photo_sizes = Column(Text)
+    description = Column(Text)
+
+class Cart(Base):
+    __tablename__ = 'cart'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=False, index=True)
+
+    # Уникальность пары (пользователь, товар) проверяет сама БД -
+    # позволяет делать INSERT ... ON CONFLICT вместо SELECT-потом-INSERT
+    __table_args__ = (
+        Index('ix_cart_user_product', 'user_id', 'product_id', unique=True),
+    )
+
+    # Товар подтягивается одним JOIN, а не отдельным SELECT при обращении
+    product = relationship('Product', lazy='joined')
+
+Base.metadata.create_all(engine)
+
+def _migrate_existing_schema():
+    """Догоняет схему старых баз: create_all не трогает уже существующие таблицы"""
+    with engine.begin() as conn:
+        columns = [row[1] for row in conn.exec_driver_sql("PRAGMA table_info(products)")]
+        if 'photo_sizes' not in columns:
+            conn.exec_driver_sql("ALTER TABLE products ADD COLUMN photo_sizes TEXT")
+
+        # Старый add_to_cart (SELECT-потом-INSERT) мог накопить дубли -
+        # убираем их, иначе уникальный индекс не создастся
+        conn.exec_driver_sql(
+            "DELETE FROM cart WHERE id NOT IN "
+            "(SELECT MIN(id) FROM cart GROUP BY user_id, product_id)"
+        )
+        conn.exec_driver_sql(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_cart_user_product "
+            "ON cart (user_id, product_id)"
+        )
+
+_migrate_existing_schema()
+# Обычная фабрика: каждый обработчик получает свою сессию. scoped_session
+# здесь нельзя - все обработчики вызывают Session() из одного потока event
+# loop и делили бы один объект, закрывая его друг у друга через db_run
+Session = sessionmaker(bind=engine)
@@ -1,22 +1,44 @@
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from database import Session, Product, Cart
+from sqlalchemy import delete as sql_delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import json
 import os
 from dotenv import load_dotenv
 import logging
 import asyncio
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+from cachetools import TTLCache
 from io import BytesIO
 from PIL import Image
 import aiohttp
-import concurrent.futures
+import functools
 import time
 
+# Опциональное ускорение коллажа: NumPy-склейка + JPEG-кодирование через OpenCV
+try:
+    import numpy as np
+    import cv2
+    HAS_CV2 = True
+except ImportError:
+    HAS_CV2 = False
+
+# uvloop (libuv) ускоряет весь асинхронный ввод-вывод; на Windows недоступен
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,6 +49,13 @@ TOKEN = os.getenv("TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
 YOUR_TELEGRAM_TAG = os.getenv("YOUR_TELEGRAM_TAG", "@your_username")
 
+# Вебхук вместо long polling: Telegram сам доставляет обновления без
+# постоянных getUpdates-запросов. Если WEBHOOK_URL не задан - работаем polling'ом
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # например https://example.com/tg
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
+
 # Проверка обязательных переменных
 if not TOKEN:
     raise ValueError("Не указан TOKEN в переменных окружения")
@@ -36,32 +65,123 @@ if not ADMIN_ID:
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher(storage=MemoryStorage())
 
-# Оптимизация: кэш для изображений и пул потоков
-image_cache = {}
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
-
-# Хранилище для данных пользователей
-user_data: Dict[int, Dict] = {}
-
-def get_main_keyboard():
-    return types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="🏎 Мейн модели"),
-             types.KeyboardButton(text="🚗 Спец. серии")],
-            [types.KeyboardButton(text="🏁 Премиум модели"),
-             types.KeyboardButton(text="🔮 Замак модели")],
-            [types.KeyboardButton(text="🚚 Тим транспорт"),
-             types.KeyboardButton(text="🛒 Корзина")],
-            [types.KeyboardButton(text="❓ Помощь")]
-        ],
-        resize_keyboard=True
-    )
+# Общая HTTP-сессия для загрузки файлов - соединения к Telegram переиспользуются
+http_session: Optional[aiohttp.ClientSession] = None
+
+async def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=32,
+                limit_per_host=16,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            )
+        )
+    return http_session
+
+@dp.shutdown()
+async def close_http_session():
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+
+# Оптимизация: ограниченный LRU-кэш для изображений
+IMAGE_CACHE_MAX = int(os.getenv("IMAGE_CACHE_MAX", 256))
+image_cache: OrderedDict[str, Image.Image] = OrderedDict()
+image_cache_lock = asyncio.Lock()
+# Незавершенные загрузки: повторный запрос того же URL ждет уже запущенную
+pending_downloads: Dict[str, asyncio.Future] = {}
+
+# Кэш готовых коллажей: категория -> (подпись товаров, jpeg, текст, кнопки)
+COLLAGE_CACHE_MAX = 16
+collage_cache: OrderedDict[str, tuple] = OrderedDict()
+
+# Кэш file_path от getFile: photo_id -> file_path (стабильны часами)
+FILE_PATH_CACHE_MAX = 512
+file_path_cache: OrderedDict[str, str] = OrderedDict()
+
+class ProductInfo(NamedTuple):
+    """Легкий слепок товара - вместо ORM-объекта в памяти пользователя"""
+    id: int
+    name: str
+    price: int
+    photo_id: str
+    description: str
+
+# Хранилище для данных пользователей: неактивные сессии вытесняются по TTL
+user_data: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+# Единый источник соответствия кнопок и категорий - вместо дублирующихся
+# словарей внутри обработчиков
+CATEGORY_BY_BUTTON = {
+    "🏎 Мейн модели": "main",
+    "🚗 Спец. серии": "special",
+    "🏁 Премиум модели": "premium",
+    "🔮 Замак модели": "zamak",
+    "🚚 Тим транспорт": "team_transport"
+}
+CATEGORY_TEXTS = frozenset(CATEGORY_BY_BUTTON)
+CATEGORY_DISPLAY_NAME = {v: k for k, v in CATEGORY_BY_BUTTON.items()}
+
+# Типизированные callback-фабрики вместо ручного разбора split('_')
+class ProductCB(CallbackData, prefix="product"):
+    id: int
+
+class AddToCartCB(CallbackData, prefix="add"):
+    id: int
+
+class RemoveFromCartCB(CallbackData, prefix="remove"):
+    id: int
 
+class BackToListCB(CallbackData, prefix="back_to_list"):
+    category: str
+
+# Статичные клавиатуры собираются один раз при импорте, а не на каждый вызов
+MAIN_KEYBOARD = types.ReplyKeyboardMarkup(
+    keyboard=[
+        [types.KeyboardButton(text="🏎 Мейн модели"),
+         types.KeyboardButton(text="🚗 Спец. серии")],
+        [types.KeyboardButton(text="🏁 Премиум модели"),
+         types.KeyboardButton(text="🔮 Замак модели")],
+        [types.KeyboardButton(text="🚚 Тим транспорт"),
+         types.KeyboardButton(text="🛒 Корзина")],
+        [types.KeyboardButton(text="❓ Помощь")]
+    ],
+    resize_keyboard=True
+)
+
+BACK_TO_MENU_BUTTON = types.InlineKeyboardButton(
+    text="⬅️ Назад в меню",
+    callback_data="back_to_menu"
+)
+
+CONTACT_REQUEST_KEYBOARD = types.ReplyKeyboardMarkup(
+    keyboard=[
+        [types.KeyboardButton(text="Отправить контакт", request_contact=True)],
+        [types.KeyboardButton(text="Отменить заказ")]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+ADD_CATEGORY_KEYBOARD = types.ReplyKeyboardMarkup(
+    keyboard=[
+        [types.KeyboardButton(text="Мейн модели (main)")],
+        [types.KeyboardButton(text="Спец. серии (special)")],
+        [types.KeyboardButton(text="Премиум модели (premium)")],
+        [types.KeyboardButton(text="Замак модели (zamak)")],
+        [types.KeyboardButton(text="Тим транспорт (team_transport)")]
+    ],
+    resize_keyboard=True
+)
+
+@functools.lru_cache(maxsize=1024)
 def get_product_keyboard(product_id: int, category: str):
     return types.InlineKeyboardMarkup(
         inline_keyboard=[
-            [types.InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=f"back_to_list_{category}"),
-             types.InlineKeyboardButton(text="➕ В корзину", callback_data=f"add_{product_id}")]
+            [types.InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=BackToListCB(category=category).pack()),
+             types.InlineKeyboardButton(text="➕ В корзину", callback_data=AddToCartCB(id=product_id).pack())]
         ]
     )
 
@@ -79,97 +199,361 @@ class AddProduct(StatesGroup):
 class DeleteProduct(StatesGroup):
     waiting_id = State()
 
+async def db_run(fn):
+    """Выполняет синхронную работу с БД в пуле потоков, не блокируя event loop"""
+    return await asyncio.to_thread(fn)
+
 async def delete_previous_messages(chat_id: int, message_ids: List[int]):
-    for msg_id in message_ids:
+    if not message_ids:
+        return
+
+    try:
+        # Один вызов deleteMessages (Bot API 7.0) вместо N последовательных запросов
+        await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+        return
+    except Exception as e:
+        logger.warning(f"Пакетное удаление не сработало, удаляем по одному: {e}")
+
+    # Фолбэк: удаляем по одному, но параллельно
+    results = await asyncio.gather(
+        *[bot.delete_message(chat_id=chat_id, message_id=msg_id) for msg_id in message_ids],
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка при удалении сообщения: {result}")
+
+def _decode_and_thumb(data: bytes) -> Image.Image:
+    """Декодирование + уменьшение до 400px целиком в рабочем потоке"""
+    img = Image.open(BytesIO(data))
+    # draft() заставляет libjpeg декодировать сразу в уменьшенном размере
+    img.draft('RGB', (400, 400))
+    img.load()
+    img.thumbnail((400, 400), Image.Resampling.BILINEAR)
+    return img
+
+async def download_image(session: aiohttp.ClientSession, url: str) -> Optional[Image.Image]:
+    """Асинхронная загрузка изображения с LRU-кэшированием"""
+    async with image_cache_lock:
+        if url in image_cache:
+            image_cache.move_to_end(url)
+            return image_cache[url]
+        # Если загрузка уже идет в другой корутине - ждем ее результат
+        waiter = pending_downloads.get(url)
+        if waiter is None:
+            pending_downloads[url] = asyncio.get_running_loop().create_future()
+
+    if waiter is not None:
+        return await waiter
+
+    image = None
+    try:
         try:
-            await bot.delete_message(chat_id=chat_id, message_id=msg_id)
+            start_time = time.time()
+            async with session.get(url) as response:
+                if response.status == 200:
+                    image_data = await response.read()
+                    logger.info(f"Загружено изображение {url} за {time.time()-start_time:.2f} сек")
+
+                    # Оптимизация: декодирование и ресайз целиком в отдельном потоке
+                    image = await asyncio.to_thread(_decode_and_thumb, image_data)
         except Exception as e:
-            logger.error(f"Ошибка при удалении сообщения: {e}")
+            logger.error(f"Ошибка загрузки изображения {url}: {e}")
+    finally:
+        # Future разрешается всегда - даже при отмене корутины-лидера,
+        # иначе все ожидающие этот URL зависнут навечно
+        async with image_cache_lock:
+            if image is not None:
+                image_cache[url] = image
+                image_cache.move_to_end(url)
+                # Вытесняем самые старые записи, чтобы кэш не рос бесконечно
+                while len(image_cache) > IMAGE_CACHE_MAX:
+                    image_cache.popitem(last=False)
+            future = pending_downloads.pop(url, None)
+            if future is not None and not future.done():
+                future.set_result(image)
+    return image
 
-async def download_image(session: aiohttp.ClientSession, url: str) -> Optional[Image.Image]:
-    """Асинхронная загрузка изображения с кэшированием"""
-    if url in image_cache:
-        return image_cache[url]
-    
+COLLAGE_TILE = 400  # размер ячейки коллажа, совпадает с размером миниатюр
+
+def _build_row(imgs: List[Image.Image], tile: int, cols: int) -> Image.Image:
+    """Собирает одну строку коллажа - вызывается параллельно для каждой строки"""
+    row_img = Image.new('RGB', (cols * tile, tile))
+    for col, img in enumerate(imgs):
+        if img.size != (tile, tile):
+            # Временную копию освобождаем сразу после вставки;
+            # оригинал остается в image_cache
+            resized = img.resize((tile, tile), Image.Resampling.BILINEAR)
+            row_img.paste(resized, (col * tile, 0))
+            resized.close()
+        else:
+            row_img.paste(img, (col * tile, 0))
+    return row_img
+
+def _build_row_cv(imgs: List[Image.Image], tile: int, cols: int) -> "np.ndarray":
+    """Строка коллажа как массив NumPy - склейка одним memcpy вместо попиксельного paste"""
+    arrays = []
+    for img in imgs:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if img.size != (tile, tile):
+            resized = img.resize((tile, tile), Image.Resampling.BILINEAR)
+            arrays.append(np.asarray(resized))
+            resized.close()
+        else:
+            arrays.append(np.asarray(img))
+    if len(arrays) < cols:
+        # Дополняем неполную строку черными ячейками до единой ширины
+        pad = (cols - len(arrays)) * tile
+        arrays.append(np.zeros((tile, pad, 3), dtype=np.uint8))
+    return np.concatenate(arrays, axis=1)
+
+def _stack_rows_and_encode_cv(row_arrays: List["np.ndarray"]) -> Optional[bytes]:
+    """Вертикальная склейка строк и JPEG-кодирование через OpenCV (libjpeg-turbo SIMD)"""
     try:
         start_time = time.time()
-        async with session.get(url) as response:
-            if response.status == 200:
-                image_data = await response.read()
-                logger.info(f"Загружено изображение {url} за {time.time()-start_time:.2f} сек")
-                
-                # Оптимизация: обработка в отдельном потоке
-                loop = asyncio.get_running_loop()
-                image = await loop.run_in_executor(
-                    executor,
-                    lambda: Image.open(BytesIO(image_data))
-                )
-                image.thumbnail((400, 400))
-                
-                image_cache[url] = image
-                return image
+        grid = np.concatenate(row_arrays, axis=0)
+        ok, buf = cv2.imencode('.jpg', cv2.cvtColor(grid, cv2.COLOR_RGB2BGR),
+                               [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+        if not ok:
+            return None
+
+        logger.info(f"Коллаж создан за {time.time()-start_time:.2f} сек")
+        return buf.tobytes()
     except Exception as e:
-        logger.error(f"Ошибка загрузки изображения {url}: {e}")
-    return None
+        logger.error(f"Ошибка создания коллажа: {e}")
+        return None
 
-def create_collage_sync(images: List[Image.Image]) -> BytesIO:
-    """Создание коллажа с оптимизацией"""
+def _stack_rows_and_encode(row_images: List[Image.Image]) -> Optional[bytes]:
+    """Склеивает готовые строки по вертикали и кодирует JPEG"""
     try:
         start_time = time.time()
-        num_images = len(images)
-        cols = min(3, num_images)
-        rows = (num_images + cols - 1) // cols
-        
-        # Используем размер первого изображения
-        img_width, img_height = images[0].size
-        
-        # Создаем новое изображение для коллажа
-        collage = Image.new('RGB', (cols * img_width, rows * img_height))
-        
-        # Вставляем изображения в коллаж
-        for i, img in enumerate(images):
-            row = i // cols
-            col = i % cols
-            collage.paste(img, (col * img_width, row * img_height))
-        
-        # Оптимизация: уменьшаем качество
+        width = row_images[0].size[0]
+        tile = row_images[0].size[1]
+
+        collage = Image.new('RGB', (width, len(row_images) * tile))
+        for i, row_img in enumerate(row_images):
+            collage.paste(row_img, (0, i * tile))
+            row_img.close()
+
+        # Оптимизация: без второго прохода Хаффмана - он доминирует во времени кодирования
         buffer = BytesIO()
-        collage.save(buffer, format='JPEG', quality=85, optimize=True)
-        buffer.seek(0)
-        
+        collage.save(buffer, format='JPEG', quality=80, optimize=False,
+                     progressive=False, subsampling=2)
+
         logger.info(f"Коллаж создан за {time.time()-start_time:.2f} сек")
-        return buffer
+        # Сразу отдаем bytes - без повторного чтения буфера на отправке
+        return buffer.getvalue()
     except Exception as e:
         logger.error(f"Ошибка создания коллажа: {e}")
         return None
 
 async def create_combined_message(photo_urls: List[str], products: List[Product], category_name: str) -> Optional[tuple]:
     """Создает объединенное сообщение с коллажем и списком товаров"""
-    async with aiohttp.ClientSession() as session:
-        # Загружаем изображения
-        tasks = [download_image(session, url) for url in photo_urls]
-        images = await asyncio.gather(*tasks)
-        images = [img for img in images if img is not None]
-        
-        if not images:
-            return None
-        
-        # Формируем текст списка товаров
-        products_text = f"📋 {category_name} - список моделей:\n\n"
-        for idx, product in enumerate(products, 1):
-            products_text += f"{idx}. {product.name} - {product.price} руб.\n"
-        
-        # Создаем коллаж в отдельном потоке
-        loop = asyncio.get_running_loop()
-        collage_buffer = await loop.run_in_executor(
-            executor,
-            lambda: create_collage_sync(images)
+    session = await get_http_session()
+
+    # Загружаем изображения
+    tasks = [download_image(session, url) for url in photo_urls]
+    images = await asyncio.gather(*tasks)
+    images = [img for img in images if img is not None]
+
+    if not images:
+        return None
+
+    # Формируем текст списка товаров
+    products_text = f"📋 {category_name} - список моделей:\n\n" + "\n".join(
+        f"{idx}. {product.name} - {product.price} руб."
+        for idx, product in enumerate(products, 1)
+    ) + "\n"
+
+    # Строки коллажа собираются параллельно в пуле потоков
+    build_row = _build_row_cv if HAS_CV2 else _build_row
+    stack_and_encode = _stack_rows_and_encode_cv if HAS_CV2 else _stack_rows_and_encode
+
+    cols = min(3, len(images))
+    row_images = await asyncio.gather(*[
+        asyncio.to_thread(build_row, images[i:i + cols], COLLAGE_TILE, cols)
+        for i in range(0, len(images), cols)
+    ])
+
+    collage_bytes = await asyncio.to_thread(stack_and_encode, row_images)
+
+    if not collage_bytes:
+        return None
+
+    return collage_bytes, products_text, len(products)
+
+def pick_collage_file_id(product: Product) -> str:
+    """file_id минимального размера фото, достаточного для ячейки коллажа.
+
+    Telegram хранит фото в нескольких разрешениях - для коллажа 400px
+    незачем скачивать оригинал в 1-2 МБ.
+    """
+    if not product.photo_sizes:
+        return product.photo_id
+    try:
+        sizes = json.loads(product.photo_sizes)
+    except (ValueError, TypeError):
+        return product.photo_id
+
+    # PhotoSize приходят по возрастанию - берем первый достаточно большой
+    for size in sizes:
+        if size.get('width', 0) >= COLLAGE_TILE and size.get('height', 0) >= COLLAGE_TILE:
+            return size['file_id']
+    return product.photo_id
+
+def products_signature(products: List[Product]) -> int:
+    """Подпись списка товаров - меняется при любом добавлении/удалении"""
+    return hash(tuple(sorted((p.id, p.photo_id, p.name, p.price) for p in products)))
+
+async def get_photo_url(photo_id: str) -> str:
+    """URL файла с кэшированием file_path, чтобы не дергать getFile каждый раз"""
+    if photo_id in file_path_cache:
+        file_path_cache.move_to_end(photo_id)
+        return f"https://api.telegram.org/file/bot{TOKEN}/{file_path_cache[photo_id]}"
+
+    file = await bot.get_file(photo_id)
+    file_path_cache[photo_id] = file.file_path
+    while len(file_path_cache) > FILE_PATH_CACHE_MAX:
+        file_path_cache.popitem(last=False)
+    return f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}"
+
+def build_category_buttons(products: List[Product]) -> list:
+    """Кнопки выбора модели по номеру + возврат в меню"""
+    buttons = []
+    row = []
+    for idx, product in enumerate(products, 1):
+        row.append(types.InlineKeyboardButton(
+            text=str(idx),
+            callback_data=ProductCB(id=product.id).pack()
+        ))
+        if idx % 3 == 0:  # 3 кнопки в строке
+            buttons.append(row)
+            row = []
+
+    if row:  # Добавляем оставшиеся кнопки
+        buttons.append(row)
+
+    buttons.append([BACK_TO_MENU_BUTTON])
+    return buttons
+
+async def build_category_payload(category: str, category_name: str, products: List[Product]) -> Optional[tuple]:
+    """Возвращает (file_id, jpeg_bytes, products_text, buttons), отдавая кэш при совпадении подписи"""
+    sig = products_signature(products)
+    cached = collage_cache.get(category)
+    if cached and cached[0] == sig:
+        collage_cache.move_to_end(category)
+        return cached[1], cached[2], cached[3], cached[4]
+
+    # Промах кэша - собираем коллаж заново из уменьшенных версий фото
+    photo_urls = await asyncio.gather(*[get_photo_url(pick_collage_file_id(p)) for p in products])
+    combined = await create_combined_message(photo_urls, products, category_name)
+
+    if not combined:
+        return None
+
+    jpeg_bytes, products_text, _ = combined
+    buttons = build_category_buttons(products)
+
+    # file_id появится после первой успешной отправки
+    collage_cache[category] = (sig, None, jpeg_bytes, products_text, buttons)
+    collage_cache.move_to_end(category)
+    while len(collage_cache) > COLLAGE_CACHE_MAX:
+        collage_cache.popitem(last=False)
+
+    return None, jpeg_bytes, products_text, buttons
+
+async def _send_media_group_view(message: types.Message, user_id: int,
+                                 category_name: str, products: List[Product]) -> bool:
+    """Показывает категорию нативной медиагруппой по file_id - без единого
+    скачивания, декодирования или загрузки байтов"""
+    products_text = f"📋 {category_name} - список моделей:\n\n" + "\n".join(
+        f"{idx}. {product.name} - {product.price} руб."
+        for idx, product in enumerate(products, 1)
+    ) + "\n"
+
+    try:
+        # Удаляем предыдущие сообщения
+        if user_id in user_data and user_data[user_id]['last_msg_ids']:
+            await delete_previous_messages(message.chat.id, user_data[user_id]['last_msg_ids'])
+
+        # sendMediaGroup принимает только 2-10 элементов -
+        # одиночный товар отправляем обычным фото с теми же подписью и кнопками
+        if len(products) == 1:
+            msg = await message.answer_photo(
+                photo=products[0].photo_id,
+                caption=products_text,
+                reply_markup=types.InlineKeyboardMarkup(
+                    inline_keyboard=build_category_buttons(products)
+                )
+            )
+            user_data[user_id]['last_msg_ids'] = [msg.message_id]
+            return True
+
+        media = [
+            types.InputMediaPhoto(
+                media=product.photo_id,
+                caption=products_text if i == 0 else None
+            )
+            for i, product in enumerate(products)
+        ]
+
+        msgs = await message.answer_media_group(media=media)
+
+        # Медиагруппа не поддерживает inline-клавиатуру - кнопки отдельным сообщением
+        buttons_msg = await message.answer(
+            "Выберите номер модели:",
+            reply_markup=types.InlineKeyboardMarkup(
+                inline_keyboard=build_category_buttons(products)
+            )
         )
-        
-        if not collage_buffer:
-            return None
-            
-        return collage_buffer, products_text, len(products)
+
+        user_data[user_id]['last_msg_ids'] = [m.message_id for m in msgs] + [buttons_msg.message_id]
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка отправки медиагруппы: {e}")
+        return False
+
+async def send_category_view(message: types.Message, user_id: int, category: str,
+                             category_name: str, products: List[Product]) -> bool:
+    """Отправляет витрину категории. False - если не удалось"""
+    # До 10 товаров Telegram показывает сам (медиагруппа, либо одно фото) -
+    # весь конвейер скачивания/склейки/кодирования не нужен
+    if len(products) <= 10:
+        if await _send_media_group_view(message, user_id, category_name, products):
+            return True
+
+    # Больше 10 товаров (или медиагруппа не прошла) - серверный коллаж
+    payload = await build_category_payload(category, category_name, products)
+
+    if not payload:
+        return False
+
+    file_id, jpeg_bytes, products_text, buttons = payload
+
+    # Удаляем предыдущие сообщения
+    if user_id in user_data and user_data[user_id]['last_msg_ids']:
+        await delete_previous_messages(message.chat.id, user_data[user_id]['last_msg_ids'])
+
+    # Повторные показы используют file_id Telegram - без загрузки байтов
+    photo = file_id if file_id else types.BufferedInputFile(jpeg_bytes, filename="collage.jpg")
+
+    # Отправляем объединенное сообщение
+    msg = await message.answer_photo(
+        photo=photo,
+        caption=products_text,
+        reply_markup=types.InlineKeyboardMarkup(inline_keyboard=buttons)
+    )
+
+    # После первой отправки запоминаем file_id коллажа в кэше
+    if file_id is None and msg.photo:
+        cached = collage_cache.get(category)
+        if cached and cached[2] is jpeg_bytes:
+            collage_cache[category] = (cached[0], msg.photo[-1].file_id) + cached[2:]
+
+    # Сохраняем ID сообщения
+    user_data[user_id]['last_msg_ids'] = [msg.message_id]
+    return True
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
@@ -177,90 +561,37 @@ async def cmd_start(message: types.Message):
         "🚗 Добро пожаловать в Hot Wheels Kriak Shop!\n\n"
         "Здесь вы можете найти нужную вам модель Hot Wheels.\n"
         "Выберите категорию:",
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
-@dp.message(lambda message: message.text in [
-    "🏎 Мейн модели", "🚗 Спец. серии", "🏁 Премиум модели",
-    "🔮 Замак модели", "🚚 Тим транспорт"
-])
+@dp.message(F.text.in_(CATEGORY_TEXTS))
 async def show_category(message: types.Message):
-    category_map = {
-        "🏎 Мейн модели": "main",
-        "🚗 Спец. серии": "special",
-        "🏁 Премиум модели": "premium",
-        "🔮 Замак модели": "zamak",
-        "🚚 Тим транспорт": "team_transport"
-    }
-    
     user_id = message.from_user.id
-    category = category_map[message.text]
+    category = CATEGORY_BY_BUTTON[message.text]
     category_name = message.text
     
     session = Session()
     try:
-        products = session.query(Product).filter(Product.category == category).all()
+        products = await db_run(lambda: session.query(Product).filter(Product.category == category).all())
         
         if not products:
             await message.answer("В этой категории пока нет товаров 😢")
             return
         
-        # Сохраняем список товаров для пользователя
+        # Сохраняем легкие слепки товаров для пользователя
         user_data[user_id] = {
             'category': category,
-            'products': {p.id: p for p in products},
+            'products': {p.id: ProductInfo(p.id, p.name, p.price, p.photo_id, p.description)
+                         for p in products},
             'last_msg_ids': []
         }
-        
-        # Получаем URL фотографий
-        file_tasks = [bot.get_file(product.photo_id) for product in products]
-        files = await asyncio.gather(*file_tasks)
-        photo_urls = [f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}" for file in files]
-        
-        # Создаем объединенное сообщение
-        combined = await create_combined_message(photo_urls, products, category_name)
-        
-        if not combined:
+
+        # Отправляем коллаж со списком и кнопками
+        if not await send_category_view(message, user_id, category, category_name, products):
             await message.answer("Ошибка при создании коллажа, показываем только список")
             await show_products_list(message, user_id)
             return
-            
-        collage_buffer, products_text, num_products = combined
-        
-        # Создаем кнопки для выбора модели
-        buttons = []
-        row = []
-        for idx in range(1, num_products + 1):
-            row.append(types.InlineKeyboardButton(
-                text=str(idx),
-                callback_data=f"product_{products[idx-1].id}"
-            ))
-            if idx % 3 == 0:  # 3 кнопки в строке
-                buttons.append(row)
-                row = []
-        
-        if row:  # Добавляем оставшиеся кнопки
-            buttons.append(row)
-        
-        buttons.append([types.InlineKeyboardButton(
-            text="⬅️ Назад в меню",
-            callback_data="back_to_menu"
-        )])
-        
-        # Удаляем предыдущие сообщения
-        if user_id in user_data and user_data[user_id]['last_msg_ids']:
-            await delete_previous_messages(message.chat.id, user_data[user_id]['last_msg_ids'])
-        
-        # Отправляем объединенное сообщение
-        msg = await message.answer_photo(
-            photo=types.BufferedInputFile(collage_buffer.read(), filename="collage.jpg"),
-            caption=products_text,
-            reply_markup=types.InlineKeyboardMarkup(inline_keyboard=buttons)
-        )
-        
-        # Сохраняем ID сообщения
-        user_data[user_id]['last_msg_ids'] = [msg.message_id]
-        
+
     except Exception as e:
         logger.error(f"Ошибка: {e}")
         await message.answer("Произошла ошибка 😢 Попробуйте позже.")
@@ -274,18 +605,13 @@ async def show_products_list(message: types.Message, user_id: int):
     
     products = list(user_data[user_id]['products'].values())
     category = user_data[user_id]['category']
-    category_name = {
-        "main": "🏎 Мейн модели",
-        "special": "🚗 Спец. серии",
-        "premium": "🏁 Премиум модели",
-        "zamak": "🔮 Замак модели",
-        "team_transport": "🚚 Тим транспорт"
-    }.get(category, category)
+    category_name = CATEGORY_DISPLAY_NAME.get(category, category)
     
     # Формируем текст списка товаров
-    products_text = f"📋 {category_name} - список моделей:\n\n"
-    for idx, product in enumerate(products, 1):
-        products_text += f"{idx}. {product.name} - {product.price} руб.\n"
+    products_text = f"📋 {category_name} - список моделей:\n\n" + "\n".join(
+        f"{idx}. {product.name} - {product.price} руб."
+        for idx, product in enumerate(products, 1)
+    ) + "\n"
     
     # Создаем кнопки для выбора модели
     buttons = []
@@ -293,7 +619,7 @@ async def show_products_list(message: types.Message, user_id: int):
     for idx, product in enumerate(products, 1):
         row.append(types.InlineKeyboardButton(
             text=str(idx),
-            callback_data=f"product_{product.id}"
+            callback_data=ProductCB(id=product.id).pack()
         ))
         if idx % 3 == 0:  # 3 кнопки в строке
             buttons.append(row)
@@ -302,10 +628,7 @@ async def show_products_list(message: types.Message, user_id: int):
     if row:  # Добавляем оставшиеся кнопки
         buttons.append(row)
     
-    buttons.append([types.InlineKeyboardButton(
-        text="⬅️ Назад в меню",
-        callback_data="back_to_menu"
-    )])
+    buttons.append([BACK_TO_MENU_BUTTON])
     
     try:
         # Удаляем предыдущие сообщения
@@ -325,11 +648,11 @@ async def show_products_list(message: types.Message, user_id: int):
         logger.error(f"Ошибка: {e}")
         await message.answer("Произошла ошибка 😢 Попробуйте позже.")
 
-@dp.callback_query(lambda c: c.data.startswith('product_'))
-async def show_product(callback: types.CallbackQuery):
+@dp.callback_query(ProductCB.filter())
+async def show_product(callback: types.CallbackQuery, callback_data: ProductCB):
     user_id = callback.from_user.id
-    product_id = int(callback.data.split('_')[1])
-    
+    product_id = callback_data.id
+
     if user_id not in user_data or product_id not in user_data[user_id]['products']:
         await callback.answer("Товар не найден")
         return
@@ -359,92 +682,46 @@ async def show_product(callback: types.CallbackQuery):
     
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "back_to_menu")
+@dp.callback_query(F.data == "back_to_menu")
 async def back_to_menu(callback: types.CallbackQuery):
     await callback.message.answer(
         "Выберите категорию:",
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith('back_to_list_'))
-async def back_to_list(callback: types.CallbackQuery):
+@dp.callback_query(BackToListCB.filter())
+async def back_to_list(callback: types.CallbackQuery, callback_data: BackToListCB):
     user_id = callback.from_user.id
-    category = callback.data.split('_')[-1]
+    category = callback_data.category
     
     if user_id not in user_data or user_data[user_id]['category'] != category:
         await callback.answer("Ошибка навигации")
         return
     
     # Получаем название категории для отображения
-    category_name = {
-        "main": "🏎 Мейн модели",
-        "special": "🚗 Спец. серии", 
-        "premium": "🏁 Премиум модели",
-        "zamak": "🔮 Замак модели",
-        "team_transport": "🚚 Тим транспорт"
-    }.get(category, category)
-    
-    # Удаляем предыдущие сообщения
-    if user_id in user_data and user_data[user_id]['last_msg_ids']:
-        await delete_previous_messages(callback.message.chat.id, user_data[user_id]['last_msg_ids'])
-    
+    category_name = CATEGORY_DISPLAY_NAME.get(category, category)
+
     session = Session()
     try:
-        products = session.query(Product).filter(Product.category == category).all()
+        products = await db_run(lambda: session.query(Product).filter(Product.category == category).all())
         
         if not products:
             await callback.message.answer("В этой категории пока нет товаров 😢")
             return
         
-        # Обновляем список товаров для пользователя
-        user_data[user_id]['products'] = {p.id: p for p in products}
-        
-        # Получаем URL фотографий
-        file_tasks = [bot.get_file(product.photo_id) for product in products]
-        files = await asyncio.gather(*file_tasks)
-        photo_urls = [f"https://api.telegram.org/file/bot{TOKEN}/{file.file_path}" for file in files]
-        
-        # Создаем объединенное сообщение
-        combined = await create_combined_message(photo_urls, products, category_name)
-        
-        if not combined:
+        # Обновляем легкие слепки товаров для пользователя
+        user_data[user_id]['products'] = {
+            p.id: ProductInfo(p.id, p.name, p.price, p.photo_id, p.description)
+            for p in products
+        }
+
+        # Отправляем коллаж со списком и кнопками
+        if not await send_category_view(callback.message, user_id, category, category_name, products):
             await callback.message.answer("Ошибка при создании коллажа, показываем только список")
             await show_products_list(callback.message, user_id)
             return
-            
-        collage_buffer, products_text, num_products = combined
-        
-        # Создаем кнопки для выбора модели
-        buttons = []
-        row = []
-        for idx in range(1, num_products + 1):
-            row.append(types.InlineKeyboardButton(
-                text=str(idx),
-                callback_data=f"product_{products[idx-1].id}"
-            ))
-            if idx % 3 == 0:  # 3 кнопки в строке
-                buttons.append(row)
-                row = []
-        
-        if row:  # Добавляем оставшиеся кнопки
-            buttons.append(row)
-        
-        buttons.append([types.InlineKeyboardButton(
-            text="⬅️ Назад в меню",
-            callback_data="back_to_menu"
-        )])
-        
-        # Отправляем объединенное сообщение
-        msg = await callback.message.answer_photo(
-            photo=types.BufferedInputFile(collage_buffer.read(), filename="collage.jpg"),
-            caption=products_text,
-            reply_markup=types.InlineKeyboardMarkup(inline_keyboard=buttons)
-        )
-        
-        # Сохраняем ID сообщения
-        user_data[user_id]['last_msg_ids'] = [msg.message_id]
-        
+
     except Exception as e:
         logger.error(f"Ошибка: {e}")
         await callback.message.answer("Произошла ошибка 😢 Попробуйте позже.")
@@ -453,22 +730,23 @@ async def back_to_list(callback: types.CallbackQuery):
     
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith('add_'))
-async def add_to_cart(callback: types.CallbackQuery):
+@dp.callback_query(AddToCartCB.filter())
+async def add_to_cart(callback: types.CallbackQuery, callback_data: AddToCartCB):
     user_id = callback.from_user.id
-    product_id = int(callback.data.split('_')[1])
+    product_id = callback_data.id
     
     session = Session()
     try:
-        exists = session.query(Cart).filter(
-            Cart.user_id == user_id,
-            Cart.product_id == product_id
-        ).first()
-        
-        if not exists:
-            cart_item = Cart(user_id=user_id, product_id=product_id)
-            session.add(cart_item)
+        # Один upsert вместо SELECT-потом-INSERT: дубликат отсеет уникальный индекс
+        def _add():
+            stmt = sqlite_insert(Cart).values(
+                user_id=user_id, product_id=product_id
+            ).on_conflict_do_nothing(index_elements=['user_id', 'product_id'])
+            result = session.execute(stmt)
             session.commit()
+            return result.rowcount
+
+        if await db_run(_add):
             await callback.answer("Товар добавлен в корзину! 🛒")
         else:
             await callback.answer("Этот товар уже в корзине")
@@ -478,7 +756,7 @@ async def add_to_cart(callback: types.CallbackQuery):
     finally:
         session.close()
 
-@dp.message(lambda message: message.text == "🛒 Корзина")
+@dp.message(F.text == "🛒 Корзина")
 async def handle_cart_message(message: types.Message):
     await show_cart(message)
 
@@ -487,21 +765,20 @@ async def show_cart(message: types.Message):
     session = Session()
     
     try:
-        cart_items = session.query(Cart).filter(Cart.user_id == user_id).all()
-        
-        if not cart_items:
-            await message.answer("Ваша корзина пуста 🛒", reply_markup=get_main_keyboard())
+        # Один запрос с JOIN вместо отдельного SELECT на каждый товар
+        cart_rows = await db_run(lambda: session.query(Cart, Product).join(
+            Product, Cart.product_id == Product.id
+        ).filter(Cart.user_id == user_id).all())
+
+        if not cart_rows:
+            await message.answer("Ваша корзина пуста 🛒", reply_markup=MAIN_KEYBOARD)
             return
-            
-        total = 0
-        cart_text = "<b>🛒 Ваша корзина:</b>\n\n"
-        
-        for item in cart_items:
-            product = session.query(Product).filter(Product.id == item.product_id).first()
-            cart_text += f"• {product.name} - {product.price} руб. [<a href='tg://btn/{item.id}'>❌</a>]\n"
-            total += product.price
-        
-        cart_text += f"\n💸 Итого к оплате: <b>{total} руб.</b>"
+
+        total = sum(product.price for _, product in cart_rows)
+        cart_text = "<b>🛒 Ваша корзина:</b>\n\n" + "\n".join(
+            f"• {product.name} - {product.price} руб. [<a href='tg://btn/{item.id}'>❌</a>]"
+            for item, product in cart_rows
+        ) + f"\n\n💸 Итого к оплате: <b>{total} руб.</b>"
         
         msg = await message.answer(
             cart_text,
@@ -526,22 +803,22 @@ async def show_cart(message: types.Message):
     finally:
         session.close()
 
-@dp.callback_query(lambda c: c.data.startswith('remove_'))
-async def remove_from_cart(callback: types.CallbackQuery):
-    cart_id = int(callback.data.split('_')[1])
+@dp.callback_query(RemoveFromCartCB.filter())
+async def remove_from_cart(callback: types.CallbackQuery, callback_data: RemoveFromCartCB):
+    cart_id = callback_data.id
     user_id = callback.from_user.id
     
     session = Session()
     try:
-        cart_item = session.query(Cart).filter(
+        cart_item = await db_run(lambda: session.query(Cart).filter(
             Cart.id == cart_id,
             Cart.user_id == user_id
-        ).first()
-        
+        ).first())
+
         if cart_item:
             product_name = cart_item.product.name
             session.delete(cart_item)
-            session.commit()
+            await db_run(session.commit)
             await callback.answer(f"Товар {product_name} удален из корзины")
             await show_cart(callback.message)
         else:
@@ -552,42 +829,38 @@ async def remove_from_cart(callback: types.CallbackQuery):
     finally:
         session.close()
 
-@dp.callback_query(lambda c: c.data == "clear_cart")
+@dp.callback_query(F.data == "clear_cart")
 async def clear_cart(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
     session = Session()
     try:
-        session.query(Cart).filter(Cart.user_id == user_id).delete()
-        session.commit()
+        def _clear():
+            session.query(Cart).filter(Cart.user_id == user_id).delete()
+            session.commit()
+
+        await db_run(_clear)
         await callback.answer("Корзина очищена!")
-        await callback.message.answer("Ваша корзина пуста 🛒", reply_markup=get_main_keyboard())
+        await callback.message.answer("Ваша корзина пуста 🛒", reply_markup=MAIN_KEYBOARD)
     except Exception as e:
         await callback.answer("Ошибка при очистке корзины 😢")
         logger.error(f"Ошибка очистки корзины: {e}")
     finally:
         session.close()
 
-@dp.callback_query(lambda c: c.data == "checkout")
+@dp.callback_query(F.data == "checkout")
 async def start_checkout(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.answer(
         "Для оформления заказа нам нужны ваши контактные данные.\n"
         "Пожалуйста, отправьте ваш тег в телеграмм (@username) или номер телефона:",
-        reply_markup=types.ReplyKeyboardMarkup(
-            keyboard=[
-                [types.KeyboardButton(text="Отправить контакт", request_contact=True)],
-                [types.KeyboardButton(text="Отменить заказ")]
-            ],
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
+        reply_markup=CONTACT_REQUEST_KEYBOARD
     )
     await state.set_state(OrderStates.waiting_phone)
 
 @dp.message(OrderStates.waiting_phone, F.contact | F.text)
 async def process_phone(message: types.Message, state: FSMContext):
     if message.text == "Отменить заказ":
-        await message.answer("Оформление заказа отменено", reply_markup=get_main_keyboard())
+        await message.answer("Оформление заказа отменено", reply_markup=MAIN_KEYBOARD)
         await state.clear()
         return
         
@@ -609,45 +882,53 @@ async def process_payment_info(message: types.Message, state: FSMContext):
     
     session = Session()
     try:
-        cart_items = session.query(Cart).filter(Cart.user_id == user_id).all()
-        
-        if not cart_items:
-            await message.answer("Ваша корзина пуста!", reply_markup=get_main_keyboard())
+        # Один запрос с JOIN вместо отдельного SELECT на каждый товар
+        cart_rows = await db_run(lambda: session.query(Cart, Product).join(
+            Product, Cart.product_id == Product.id
+        ).filter(Cart.user_id == user_id).all())
+
+        if not cart_rows:
+            await message.answer("Ваша корзина пуста!", reply_markup=MAIN_KEYBOARD)
             await state.clear()
             return
             
-        # Формируем сообщение для пользователя
-        order_text = "✅ Ваш заказ оформлен!\n\n"
-        order_text += f"📞 Ваши контакты: {contact}\n"
-        order_text += f"💳 Способ оплаты: {payment_info}\n\n"
-        order_text += "🛒 Состав заказа:\n"
-        
-        # Формируем сообщение для администратора
-        admin_order_text = "🆕 НОВЫЙ ЗАКАЗ!\n\n"
-        admin_order_text += f"👤 Пользователь: {user_tag}\n"
-        admin_order_text += f"📞 Контакты: {contact}\n"
-        admin_order_text += f"💳 Способ оплаты: {payment_info}\n\n"
-        admin_order_text += "📦 Заказанные товары:\n"
-        
-        total = 0
-        for item in cart_items:
-            product = session.query(Product).filter(Product.id == item.product_id).first()
-            order_text += f"• {product.name} - {product.price} руб.\n"
-            admin_order_text += f"• {product.name} - {product.price} руб.\n"
-            total += product.price
-        
-        order_text += f"\n💸 Итого к оплате: <b>{total} руб.</b>\n\n"
-        order_text += "Спасибо за заказ! Мы свяжемся с вами в ближайшее время."
-        
-        admin_order_text += f"\n💰 Общая сумма: <b>{total} руб.</b>\n"
-        admin_order_text += "\n✉️ Пользователь ожидает вашего ответа!"
+        # Состав заказа и сумма считаются один раз для обоих сообщений
+        items_text = "\n".join(f"• {product.name} - {product.price} руб."
+                               for _, product in cart_rows)
+        total = sum(product.price for _, product in cart_rows)
+
+        # Сообщение для пользователя
+        order_text = (
+            "✅ Ваш заказ оформлен!\n\n"
+            f"📞 Ваши контакты: {contact}\n"
+            f"💳 Способ оплаты: {payment_info}\n\n"
+            "🛒 Состав заказа:\n"
+            f"{items_text}\n"
+            f"\n💸 Итого к оплате: <b>{total} руб.</b>\n\n"
+            "Спасибо за заказ! Мы свяжемся с вами в ближайшее время."
+        )
+
+        # Сообщение для администратора
+        admin_order_text = (
+            "🆕 НОВЫЙ ЗАКАЗ!\n\n"
+            f"👤 Пользователь: {user_tag}\n"
+            f"📞 Контакты: {contact}\n"
+            f"💳 Способ оплаты: {payment_info}\n\n"
+            "📦 Заказанные товары:\n"
+            f"{items_text}\n"
+            f"\n💰 Общая сумма: <b>{total} руб.</b>\n"
+            "\n✉️ Пользователь ожидает вашего ответа!"
+        )
         
         # Очищаем корзину
-        session.query(Cart).filter(Cart.user_id == user_id).delete()
-        session.commit()
+        def _clear():
+            session.query(Cart).filter(Cart.user_id == user_id).delete()
+            session.commit()
+
+        await db_run(_clear)
         
         # Отправляем подтверждение пользователю
-        await message.answer(order_text, reply_markup=get_main_keyboard())
+        await message.answer(order_text, reply_markup=MAIN_KEYBOARD)
         
         # Уведомляем администратора
         await bot.send_message(
@@ -663,7 +944,7 @@ async def process_payment_info(message: types.Message, state: FSMContext):
         session.close()
         await state.clear()
 
-@dp.message(lambda message: message.text == "❓ Помощь")
+@dp.message(F.text == "❓ Помощь")
 async def show_help(message: types.Message):
     help_text = (
         "ℹ️ <b>Помощь и поддержка</b>\n\n"
@@ -676,7 +957,7 @@ async def show_help(message: types.Message):
     await message.answer(
         help_text,
         parse_mode=ParseMode.HTML,
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
 @dp.message(Command("add"))
@@ -690,7 +971,14 @@ async def cmd_add(message: types.Message, state: FSMContext):
 
 @dp.message(AddProduct.waiting_photo, F.photo)
 async def process_photo(message: types.Message, state: FSMContext):
-    await state.update_data(photo_id=message.photo[-1].file_id)
+    # Запоминаем все размеры фото, чтобы для коллажа качать уменьшенную версию
+    await state.update_data(
+        photo_id=message.photo[-1].file_id,
+        photo_sizes=json.dumps([
+            {"file_id": p.file_id, "width": p.width, "height": p.height}
+            for p in message.photo
+        ])
+    )
     await message.answer("Отлично! Теперь введите название товара:")
     await state.set_state(AddProduct.waiting_name)
 
@@ -713,19 +1001,8 @@ async def process_price(message: types.Message, state: FSMContext):
 @dp.message(AddProduct.waiting_description)
 async def process_description(message: types.Message, state: FSMContext):
     await state.update_data(description=message.text)
-    
-    keyboard = types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="Мейн модели (main)")],
-            [types.KeyboardButton(text="Спец. серии (special)")],
-            [types.KeyboardButton(text="Премиум модели (premium)")],
-            [types.KeyboardButton(text="Замак модели (zamak)")],
-            [types.KeyboardButton(text="Тим транспорт (team_transport)")]
-        ],
-        resize_keyboard=True
-    )
-    
-    await message.answer("Выберите категорию:", reply_markup=keyboard)
+
+    await message.answer("Выберите категорию:", reply_markup=ADD_CATEGORY_KEYBOARD)
     await state.set_state(AddProduct.waiting_category)
 
 @dp.message(AddProduct.waiting_category)
@@ -752,22 +1029,30 @@ async def process_category(message: types.Message, state: FSMContext):
             name=data['name'],
             price=data['price'],
             photo_id=data['photo_id'],
+            photo_sizes=data.get('photo_sizes'),
             description=data['description']
         )
         
-        session.add(new_product)
-        session.commit()
+        def _save():
+            session.add(new_product)
+            session.commit()
+
+        await db_run(_save)
+
+        # Сбрасываем кэш коллажа - состав категории изменился
+        collage_cache.pop(category, None)
+
         await message.answer(
             f"✅ Товар успешно добавлен в категорию {category}!\n\n"
             f"Название: {new_product.name}\n"
             f"Цена: {new_product.price} руб.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
     except Exception as e:
         logger.error(f"Ошибка добавления товара: {e}")
         await message.answer("❌ Ошибка при сохранении товара")
     finally:
-        session.close()
+        await db_run(session.close)
         await state.clear()
 
 @dp.message(Command("delete"))
@@ -778,7 +1063,7 @@ async def cmd_delete(message: types.Message, state: FSMContext):
         
     session = Session()
     try:
-        products = session.query(Product).all()
+        products = await db_run(lambda: session.query(Product).all())
         if not products:
             await message.answer("Нет товаров для удаления")
             return
@@ -790,56 +1075,94 @@ async def cmd_delete(message: types.Message, state: FSMContext):
         )
         await state.set_state(DeleteProduct.waiting_id)
     finally:
-        session.close()
+        await db_run(session.close)
 
 @dp.message(DeleteProduct.waiting_id)
 async def process_delete_id(message: types.Message, state: FSMContext):
     try:
-        # Получаем все ID из сообщения
-        ids = message.text.split()
-        deleted_products = []
+        # Разбираем ID из сообщения; нечисловые сразу в "не найдены"
+        valid_ids = []
         not_found_ids = []
-        
-        session = Session()
-        
-        for id_str in ids:
+        for id_str in message.text.split():
             try:
-                product_id = int(id_str)
-                product = session.query(Product).filter(Product.id == product_id).first()
-                
-                if product:
-                    session.delete(product)
-                    deleted_products.append(product.name)
-                else:
-                    not_found_ids.append(str(product_id))
+                valid_ids.append(int(id_str))
             except ValueError:
                 not_found_ids.append(id_str)
-        
-        session.commit()
-        
-        response = ""
+
+        session = Session()
+
+        def _delete_products():
+            if not valid_ids:
+                return []
+            # Один DELETE ... RETURNING вместо пары SELECT+DELETE на каждый ID
+            stmt = sql_delete(Product).where(Product.id.in_(valid_ids)).returning(
+                Product.id, Product.name, Product.category
+            )
+            rows = session.execute(stmt).all()
+            session.commit()
+            return rows
+
+        deleted_rows = await db_run(_delete_products)
+
+        deleted_products = [row.name for row in deleted_rows]
+        affected_categories = {row.category for row in deleted_rows}
+        found_ids = {row.id for row in deleted_rows}
+        not_found_ids.extend(str(i) for i in valid_ids if i not in found_ids)
+
+        # Сбрасываем кэш коллажей затронутых категорий
+        for cat in affected_categories:
+            collage_cache.pop(cat, None)
+
+        parts = []
         if deleted_products:
-            response += "✅ Удалены товары:\n" + "\n".join(f"• {name}" for name in deleted_products) + "\n\n"
+            parts.append("✅ Удалены товары:\n" + "\n".join([f"• {name}" for name in deleted_products]))
         if not_found_ids:
-            response += "❌ Не найдены товары с ID: " + ", ".join(not_found_ids)
-            
-        await message.answer(response if response else "Ничего не удалено", reply_markup=get_main_keyboard())
-        
+            parts.append("❌ Не найдены товары с ID: " + ", ".join(not_found_ids))
+        response = "\n\n".join(parts) or "Ничего не удалено"
+
+        # Ответ и сброс состояния независимы - выполняем параллельно
+        await asyncio.gather(
+            message.answer(response, reply_markup=MAIN_KEYBOARD),
+            state.clear()
+        )
+
     except Exception as e:
-        await message.answer(f"❌ Произошла ошибка при удалении: {str(e)}")
         logger.error(f"Ошибка удаления товаров: {e}")
+        await asyncio.gather(
+            message.answer(f"❌ Произошла ошибка при удалении: {str(e)}"),
+            state.clear()
+        )
     finally:
-        session.close()
-        await state.clear()
+        # Закрытие сессии не задерживает ответ пользователю
+        asyncio.get_running_loop().run_in_executor(None, session.close)
 
 @dp.message(Command("myid"))
 async def cmd_myid(message: types.Message):
-    await message.answer(f"Ваш ID: {message.from_user.id}\n"
-                       f"Ваш тег: @{message.from_user.username if message.from_user.username else 'отсутствует'}")
+    # Прямой send_message дешевле, чем answer() с его reply-обвязкой
+    uname = message.from_user.username or 'отсутствует'
+    await bot.send_message(
+        message.chat.id,
+        f"Ваш ID: {message.from_user.id}\nВаш тег: @{uname}"
+    )
 
 async def main():
     await dp.start_polling(bot)
 
+async def _set_webhook(bot: Bot):
+    await bot.set_webhook(WEBHOOK_URL)
+
+def run_webhook():
+    dp.startup.register(_set_webhook)
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+
 if __name__ == '__main__':
+    if uvloop is not None:
+        uvloop.install()
     print("Бот запущен! 🚀")
-    asyncio.run(main())
\ No newline at end of file
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        asyncio.run(main())
\ No newline at end of file